@@ -1,16 +1,77 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse
 from typing import List, Optional
+from contextlib import asynccontextmanager
+from hashlib import blake2b
+import asyncio
+import logging
 import os
-import json
+import re
+import orjson
+import msgspec
+from cachetools import LFUCache
 from dotenv import load_dotenv
-from cerebras.cloud.sdk import Cerebras
+from cerebras.cloud.sdk import AsyncCerebras, DefaultAsyncHttpxClient
+import httpx
 import uvicorn
 
 load_dotenv()
 
-app = FastAPI(title="Mediator Bot API")
+# Configured at import so every uvicorn worker process picks it up; LOG_LEVEL
+# applies to this app's logger only, so DEBUG doesn't turn on library noise
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("mediator")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+class MsgspecJSONResponse(JSONResponse):
+    """JSON response rendered by msgspec instead of the stdlib encoder"""
+
+    def render(self, content) -> bytes:
+        return _resp_encoder.encode(content)
+
+
+# Cerebras client, created per worker process on startup
+cerebras_client = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Give each worker its own Cerebras client and connection pool"""
+    global cerebras_client, semantic_cache
+    api_key = os.getenv("CEREBRAS_API_KEY")
+    if api_key:
+        # One keep-alive pool per worker; HTTP/2 multiplexes concurrent
+        # completions over a single TCP+TLS connection
+        cerebras_client = AsyncCerebras(
+            api_key=api_key,
+            http_client=DefaultAsyncHttpxClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+                timeout=httpx.Timeout(30.0),
+            ),
+        )
+
+    redis_url = os.getenv("REDIS_URL")
+    if redis_url:
+        try:
+            semantic_cache = await asyncio.to_thread(build_semantic_cache, app, redis_url)
+        except Exception as e:
+            logger.warning("Semantic cache disabled: %s", e)
+
+    yield
+
+    semantic_cache = None
+    if cerebras_client:
+        await cerebras_client.close()
+        cerebras_client = None
+
+
+app = FastAPI(
+    title="Mediator Bot API",
+    default_response_class=MsgspecJSONResponse,
+    lifespan=lifespan,
+)
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,22 +83,176 @@ app.add_middleware(
 
 
 
-# Initialize Cerebras client
-cerebras_client = None
-api_key = os.getenv("CEREBRAS_API_KEY")
-if api_key:
-    cerebras_client = Cerebras(api_key=api_key)
-
-
-class Message(BaseModel):
+# Cap in-flight Cerebras calls so concurrent requests don't overwhelm the backend.
+# Applies per worker; when swapping in a local backend such as Ollama, keep
+# this in line with its own parallelism setting (e.g. OLLAMA_NUM_PARALLEL).
+cerebras_semaphore = asyncio.Semaphore(int(os.getenv("CEREBRAS_MAX_CONCURRENCY", "8")))
+
+# Exact-match cache keyed on a hash of the formatted conversation
+response_cache = LFUCache(maxsize=int(os.getenv("RESPONSE_CACHE_SIZE", "4096")))
+
+# Optional semantic cache that also catches paraphrases (needs Redis + redisvl).
+# Built per worker on startup around one shared, pre-warmed embedding model.
+# For the fastest CPU path, export the model with
+# `optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 --optimize O3`
+# and point EMBEDDING_MODEL at the exported directory.
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "onnx")
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", "86400"))
+semantic_cache = None
+
+
+def build_semantic_cache(app: FastAPI, redis_url: str):
+    """Load and warm the embedding model, then wrap it in a SemanticCache"""
+    from redisvl.extensions.llmcache import SemanticCache
+    from redisvl.utils.vectorize import CustomTextVectorizer
+    from sentence_transformers import SentenceTransformer
+
+    embed_model = SentenceTransformer(EMBEDDING_MODEL, backend=EMBEDDING_BACKEND)
+    # Pay model/kernel initialisation here rather than on the first request
+    embed_model.encode("warmup")
+    app.state.embed = embed_model
+
+    return SemanticCache(
+        name="mediator_by_conversation",
+        redis_url=redis_url,
+        distance_threshold=0.1,
+        ttl=SEMANTIC_CACHE_TTL,
+        filterable_fields=[{"name": "conversation_id", "type": "tag"}],
+        vectorizer=CustomTextVectorizer(
+            embed=lambda text: embed_model.encode(text).tolist(),
+            embed_many=lambda texts: embed_model.encode(texts, batch_size=32).tolist(),
+        ),
+    )
+
+
+# Kept identical across calls so the provider can reuse the cached prompt prefix
+SYSTEM_PROMPT = """You are a mediator for a group house chat. I want you to notice messages that are excessively far from being phrased in NVC when conversations are becoming heated. Respond with {"status": "ok", "response": ""} when the convo is ok. Respond as a mediator and with a suggested NVC translation in other cases. The user message contains the most recent messages of the chat.
+
+If mediation is needed return a JSON like this: {"status": "mediate", "response": "I notice some tension here. Let me help translate this using NVC.", "observations": "I observe that harsh words were used", "feelings": "There seems to be frustration and hurt", "needs": "The need for respect and understanding", "requests": "Could you try expressing your concern without blame?"}. Otherwise return {"status": "ok", "response": ""}."""
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Constrained decoding guarantees the reply is a single object of this shape
+MEDIATION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "mediation",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "status": {"type": "string", "enum": ["ok", "mediate"]},
+                "response": {"type": "string"},
+                "observations": {"type": "string"},
+                "feelings": {"type": "string"},
+                "needs": {"type": "string"},
+                "requests": {"type": "string"},
+            },
+            "required": ["status", "response"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+# Phrasings that are typically far from NVC. Messages matching none of these,
+# and showing no punctuation/caps heat, skip the LLM call entirely. Set
+# HEAT_GATE_ENABLED=false to send every turn to the LLM instead.
+HEAT_GATE_ENABLED = os.getenv("HEAT_GATE_ENABLED", "true").lower() not in (
+    "0",
+    "false",
+    "no",
+    "off",
+)
+HEAT_PATTERNS = [
+    r"\byou(['’]?re| are)? (always|never|so|constantly|keep|only ever)\b",
+    r"\bonly ever\b",
+    r"\bdone with (you|this)\b",
+    r"\bcan['’]?t believe (you|this)\b",
+    r"\bworst\b",
+    r"\bannoying\b",
+    r"\b(always|never) (do|does|did|clean|listen|help|care)\b",
+    r"\beveryone (always|knows)\b",
+    r"\bnobody (ever|cares)\b",
+    r"\bwhat['’]?s wrong with you\b",
+    r"\bwhy (can['’]?t|don['’]?t|won['’]?t) you\b",
+    r"\bhow many times\b",
+    r"\bi['’]?m (sick|tired) of\b",
+    r"\bfed up\b",
+    r"\bsick of\b",
+    r"\bi hate\b",
+    r"\bhate (you|this|living)\b",
+    r"\bshut up\b",
+    r"\bget out\b",
+    r"\bleave me alone\b",
+    r"\bgrow up\b",
+    r"\bdeal with it\b",
+    r"\bwhatever\b",
+    r"\bseriously\?",
+    r"\bare you (kidding|serious|stupid|deaf|blind)\b",
+    r"\byour fault\b",
+    r"\bblame\b",
+    r"\bselfish\b",
+    r"\blazy\b",
+    r"\bdisgusting\b",
+    r"\bgross\b",
+    r"\bridiculous\b",
+    r"\bpathetic\b",
+    r"\buseless\b",
+    r"\bworthless\b",
+    r"\brude\b",
+    r"\binconsiderate\b",
+    r"\bimmature\b",
+    r"\bslob\b",
+    r"\bpig\b",
+    r"\bidiot(ic|s)?\b",
+    r"\bstupid\b",
+    r"\bdumb\b",
+    r"\bmoron\b",
+    r"\bjerk\b",
+    r"\bloser\b",
+    r"\bcrap(py)?\b",
+    r"\bdamn(ed)?\b",
+    r"\bhell\b",
+    r"\bwtf\b",
+    r"\bstfu\b",
+    r"\bf+u+c+k+\w*",
+    r"\bsh[i1]t+\w*",
+    r"\bb[i1]tch\w*",
+    r"\ba(ss|rse)(hole)?\b",
+    r"\bpiss(ed)?\b",
+]
+HEAT_REGEX = re.compile("|".join(HEAT_PATTERNS), re.IGNORECASE)
+SHOUTING_REGEX = re.compile(r"\b[A-Z]{3,}\b")
+
+
+def is_heated(text: str) -> bool:
+    """Cheap local check for whether a message might need mediation"""
+    if HEAT_REGEX.search(text):
+        return True
+    if text.count("!") >= 2 or "?!" in text or "!?" in text:
+        return True
+    return len(SHOUTING_REGEX.findall(text)) >= 2
+
+
+# Holds only strings and can't form reference cycles, so skip GC tracking
+class Message(msgspec.Struct, gc=False):
     role: str
     content: str
 
 
-class MessageRequest(BaseModel):
+class MessageRequest(msgspec.Struct):
     messages: List[Message]
+    # Opaque client-side identifier; scopes the semantic cache to one chat
+    conversation_id: Optional[str] = None
 
-class MessageResponse(BaseModel):
+
+class MessageBatchRequest(msgspec.Struct):
+    batches: List[List[Message]]
+
+
+# Only built internally, so construction is left unvalidated; inbound
+# request bodies are still validated by the decoders below
+class MessageResponse(msgspec.Struct, frozen=True, gc=False):
     response: str
     mediation_triggered: bool = False
     observations: Optional[str] = None
@@ -46,101 +261,205 @@ class MessageResponse(BaseModel):
     requests: Optional[str] = None
 
 
-def process_mediation(messages: List[Message]) -> MessageResponse:
-    """Process messages for mediation using NVC approach"""
-    print("Starting process_mediation")
-    
-    if not cerebras_client:
-        print("No Cerebras client found, returning default response")
-        return MessageResponse(
-            response="I'm listening. Continue your conversation.",
-            mediation_triggered=False,
+# Canned responses are constant, so every no-op and fallback return shares
+# one immutable instance
+_NO_MEDIATION = MessageResponse(
+    response="I'm listening. Continue your conversation.",
+    mediation_triggered=False,
+)
+_STEP_BACK = MessageResponse(
+    response="Let's take a step back and try to understand each other's perspectives.",
+    mediation_triggered=False,
+)
+_MEDIATION_TRUNCATED = MessageResponse(
+    response="Let me help mediate this conversation.",
+    mediation_triggered=True,
+)
+
+
+# msgspec decodes and validates request JSON in a single pass
+_req_decoder = msgspec.json.Decoder(MessageRequest)
+_batch_req_decoder = msgspec.json.Decoder(MessageBatchRequest)
+_resp_decoder = msgspec.json.Decoder(MessageResponse)
+_resp_encoder = msgspec.json.Encoder()
+
+
+def decode_body(decoder: msgspec.json.Decoder, body: bytes):
+    """Decode a request body, surfacing validation errors as a 422"""
+    try:
+        return decoder.decode(body)
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def parse_mediation_response(ai_response: str) -> MessageResponse:
+    """Turn the schema-constrained model output into a MessageResponse"""
+    parsed_response = orjson.loads(ai_response)
+    logger.debug("Parsed JSON response:\n%s", parsed_response)
+
+    if parsed_response["status"] != "mediate":
+        logger.debug("No mediation needed, returning default response")
+        return _NO_MEDIATION
+
+    return MessageResponse(
+        response=parsed_response["response"] or "Let me help mediate this conversation.",
+        mediation_triggered=True,
+        observations=parsed_response.get("observations"),
+        feelings=parsed_response.get("feelings"),
+        needs=parsed_response.get("needs"),
+        requests=parsed_response.get("requests"),
+    )
+
+
+async def lookup_cached_response(
+    key: str, messages_text: str, conversation_id: Optional[str]
+) -> Optional[MessageResponse]:
+    """Check the exact-match cache, then the conversation's semantic cache"""
+    cached = response_cache.get(key)
+    if cached is not None:
+        logger.debug("Exact cache hit")
+        return cached
+
+    # Semantic hits are scoped to one conversation so one chat's mediation text
+    # (names, quoted messages) is never served to another
+    if semantic_cache is None or conversation_id is None:
+        return None
+
+    try:
+        from redisvl.query.filter import Tag
+
+        hits = await asyncio.to_thread(
+            semantic_cache.check,
+            prompt=messages_text,
+            num_results=1,
+            filter_expression=Tag("conversation_id") == conversation_id,
         )
+        if not hits:
+            return None
+        cached = _resp_decoder.decode(hits[0]["response"])
+    except Exception as e:
+        # Treat lookup failures and stale/malformed entries as a miss
+        logger.warning("Semantic cache lookup failed: %s", e)
+        return None
 
-    print(f"Messages: {messages}")
-    # Format messages for the prompt
-    messages_text = "\n".join([f"{msg.role}: {msg.content}" for msg in messages[-5:]])
-    print(f"Formatted messages for prompt:\n{messages_text}")
+    logger.debug("Semantic cache hit")
+    response_cache[key] = cached
+    return cached
 
-    prompt = f"""You are a mediator for a group house chat. I want you to notice messages that are excessively far from being phrased in NVC when conversations are becoming heated. Respond with {{"response": "[[NO MEDIATION NEEDED]]"}} when the convo is ok. Respond as a mediator and with a suggested NVC translation in other cases.
-{messages_text}
 
-Think step by step, if mediation is needed return a JSON like this: {{"response": "I notice some tension here. Let me help translate this using NVC.", "observations": "I observe that harsh words were used", "feelings": "There seems to be frustration and hurt", "needs": "The need for respect and understanding", "requests": "Could you try expressing your concern without blame?"}}. Otherwise return {{"response": "[[NO MEDIATION NEEDED]]"}}."""
+async def store_cached_response(
+    key: str, messages_text: str, conversation_id: Optional[str], result: MessageResponse
+) -> None:
+    """Remember a mediation result in both cache levels"""
+    response_cache[key] = result
+
+    if semantic_cache is None or conversation_id is None:
+        return
 
-    print("Sending request to Cerebras API")
     try:
-        response = cerebras_client.chat.completions.create(
+        await asyncio.to_thread(
+            semantic_cache.store,
+            prompt=messages_text,
+            response=_resp_encoder.encode(result).decode(),
+            filters={"conversation_id": conversation_id},
+        )
+    except Exception as e:
+        logger.warning("Semantic cache store failed: %s", e)
+
+
+class CompletionTruncated(Exception):
+    """The reply hit max_tokens, so its JSON is incomplete"""
+
+
+async def request_completion(messages_text: str) -> str:
+    """Send one formatted conversation to Cerebras and return the raw reply"""
+    logger.debug("Sending request to Cerebras API")
+    async with cerebras_semaphore:
+        response = await cerebras_client.chat.completions.create(
             model="llama3.1-8b",
-            messages=[{"role": "user", "content": prompt}],
+            messages=[SYSTEM_MESSAGE, {"role": "user", "content": messages_text}],
+            # Headroom for a full mediation reply; truncation is detected below
             max_tokens=300,
-            temperature=0.7,
+            # Deterministic sampling, since every result populates the cache
+            temperature=0.0,
+            top_p=1.0,
+            response_format=MEDIATION_RESPONSE_FORMAT,
             stream=False,  # Explicitly disable streaming
         )
+    choice = response.choices[0]
+    if choice.finish_reason == "length":
+        raise CompletionTruncated(choice.message.content or "")
+    return choice.message.content.strip()
 
-        ai_response = response.choices[0].message.content.strip()
-        print(f"Received AI response:\n{ai_response}")
 
-        # Try to parse JSON response
-        try:
-            # First check if it's the no mediation needed response
-            if "[[NO MEDIATION NEEDED]]" in ai_response:
-                print("No mediation needed, returning default response")
-                return MessageResponse(
-                    response="I'm listening. Continue your conversation.",
-                    mediation_triggered=False,
-                )
-
-            # Try to extract JSON from the response
-            json_start = ai_response.find("{")
-            json_end = ai_response.rfind("}") + 1
-
-            if json_start != -1 and json_end > json_start:
-                json_str = ai_response[json_start:json_end]
-                print(f"Extracted JSON string:\n{json_str}")
-                parsed_response = json.loads(json_str)
-                print(f"Successfully parsed JSON response:\n{parsed_response}")
-
-                return MessageResponse(
-                    response=parsed_response.get(
-                        "response", "Let me help mediate this conversation."
-                    ),
-                    mediation_triggered=True,
-                    observations=parsed_response.get("observations"),
-                    feelings=parsed_response.get("feelings"),
-                    needs=parsed_response.get("needs"),
-                    requests=parsed_response.get("requests"),
-                )
-            else:
-                print("No JSON structure found in response, using fallback")
-                # Fallback if no JSON structure found
-                return MessageResponse(
-                    response=ai_response,
-                    mediation_triggered=True,
-                )
-
-        except json.JSONDecodeError as e:
-            print(f"JSON parsing error: {e}")
-            print(f"Raw response that failed to parse: {ai_response}")
-            # Fallback for JSON parsing errors
-            return MessageResponse(
-                response=ai_response,
-                mediation_triggered=True,
-            )
+async def process_mediation(
+    messages: List[Message], conversation_id: Optional[str] = None
+) -> MessageResponse:
+    """Process messages for mediation using NVC approach"""
+    logger.debug("Starting process_mediation")
+    
+    if not cerebras_client:
+        logger.debug("No Cerebras client found, returning default response")
+        return _NO_MEDIATION
+
+    if not messages or (HEAT_GATE_ENABLED and not is_heated(messages[-1].content)):
+        logger.debug("Latest message looks calm, skipping mediation")
+        return _NO_MEDIATION
+
+    logger.debug("Messages: %s", messages)
+    # Format messages for the prompt
+    messages_text = "\n".join(msg.role + ": " + msg.content for msg in messages[-5:])
+    logger.debug("Formatted messages for prompt:\n%s", messages_text)
+
+    cache_key = blake2b(messages_text.encode()).hexdigest()
+    cached = await lookup_cached_response(cache_key, messages_text, conversation_id)
+    if cached is not None:
+        return cached
+
+    try:
+        ai_response = await request_completion(messages_text)
+        logger.debug("Received AI response:\n%s", ai_response)
+
+        result = parse_mediation_response(ai_response)
+
+    except CompletionTruncated as e:
+        # Only a long mediation reply runs out of tokens, so still flag it
+        logger.warning("Mediation reply truncated at max_tokens (%d chars)", len(str(e)))
+        logger.debug("Truncated reply: %s", e)
+        return _MEDIATION_TRUNCATED
 
     except Exception as e:
-        print(f"API error occurred: {str(e)}")
-        # Fallback for API errors
-        return MessageResponse(
-            response="Let's take a step back and try to understand each other's perspectives.",
-            mediation_triggered=False,
-        )
+        logger.warning("Mediation request failed: %s", e)
+        # Fallback for API errors and unparseable replies
+        return _STEP_BACK
+
+    await store_cached_response(cache_key, messages_text, conversation_id, result)
+    return result
 
 
 @app.post("/chat")
-async def chat(request: MessageRequest):
+async def chat(request: Request) -> Response:
     """Main chat endpoint with NVC mediation"""
-    print(f"Received request: {request}")
-    return process_mediation(request.messages)
+    req = decode_body(_req_decoder, await request.body())
+    logger.debug("Received request: %s", req)
+    result = await process_mediation(req.messages, req.conversation_id)
+    return MsgspecJSONResponse(result)
+
+
+@app.post("/chat/batch")
+async def chat_batch(request: Request) -> Response:
+    """Mediate several conversations concurrently"""
+    req = decode_body(_batch_req_decoder, await request.body())
+    logger.debug("Received batch request with %d conversations", len(req.batches))
+    results = await asyncio.gather(
+        *[process_mediation(batch) for batch in req.batches],
+        return_exceptions=True,
+    )
+    responses = [
+        result if isinstance(result, MessageResponse) else _STEP_BACK
+        for result in results
+    ]
+    return MsgspecJSONResponse(responses)
 
 
 @app.get("/")
@@ -150,5 +469,13 @@ async def root():
 
 if __name__ == "__main__":
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="uvloop",
+        http="httptools",
+        log_level="info",
+    )
 
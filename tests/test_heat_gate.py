@@ -0,0 +1,42 @@
+import pytest
+
+from main import is_heated
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "You never clean the kitchen",
+        "you're always late",
+        "youre always late",
+        "you are always late",
+        "You're so annoying, I can't believe you did this again.",
+        "You are the worst roommate ever",
+        "You only ever think about yourself",
+        "I'm done with you",
+        "What's wrong with you",
+        "What’s wrong with you",
+        "Why don’t you ever do the dishes",
+        "I’m tired of this",
+        "this is ridiculous!!",
+        "WHY IS THE SINK FULL",
+        "what the fuck",
+    ],
+)
+def test_heated_messages_trigger_gate(text):
+    assert is_heated(text)
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "hey, dinner at 7?",
+        "ok sounds good",
+        "Can someone grab milk on the way home?",
+        "Thanks for taking out the trash!",
+        "I'll be back around 10 tonight",
+        "Does anyone mind if I have friends over on Saturday?",
+    ],
+)
+def test_calm_messages_pass_gate(text):
+    assert not is_heated(text)